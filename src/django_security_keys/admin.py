@@ -7,6 +7,10 @@ from django_security_keys.models import SecurityKey
 class SecurityKeyAdmin(admin.ModelAdmin):
     list_display = ("user", "name", "sign_count", "created", "updated")
 
+    # join the user in the changelist query instead of fetching it per row
+    list_select_related = ("user",)
+    list_per_page = 50
+
     # user autocomplete
     autocomplete_fields = ("user",)
 
@@ -10,12 +10,17 @@ from __future__ import annotations
 
 from typing import Any
 
+from django.contrib.auth import get_user_model
 from django.contrib.auth.backends import ModelBackend
 from django.contrib.auth.models import User
 from django.core.handlers.wsgi import WSGIRequest
 
 from django_security_keys.models import SecurityKey
 
+# marks that the login view did not resolve the user for the backend
+
+_NOT_PREFETCHED = object()
+
 
 class PasswordlessAuthenticationBackend(ModelBackend):
 
@@ -37,10 +42,7 @@ class PasswordlessAuthenticationBackend(ModelBackend):
 
         # clean up last used passwordless key
 
-        try:
-            del request.session["webauthn_passwordless"]
-        except KeyError:
-            pass
+        request.session.pop("webauthn_passwordless", None)
 
         credential = kwargs.get("u2f_credential")
 
@@ -51,21 +53,42 @@ class PasswordlessAuthenticationBackend(ModelBackend):
         if not username or not credential:
             return
 
-        has_credentials = SecurityKey.credentials(
-            username, request.session, for_login=True
+        # resolve the user once and pass the instance on so credential
+        # lookups can filter on the user id directly
+        #
+        # the login view may already have resolved the user, in which
+        # case it is made available as `request._prefetched_user` (None
+        # if the user does not exist)
+
+        UserModel = get_user_model()
+        user = getattr(request, "_prefetched_user", _NOT_PREFETCHED)
+
+        if user is _NOT_PREFETCHED or (
+            user is not None and user.get_username() != username
+        ):
+            try:
+                user = UserModel._default_manager.get_by_natural_key(username)
+            except UserModel.DoesNotExist:
+                user = None
+
+        has_credentials = user is not None and SecurityKey.has_credentials(
+            user, request.session, for_login=True
         )
 
-        # no credential supplied
+        # unknown user or no password-less keys, run the password hasher
+        # once (as ModelBackend does for unknown users) so the response
+        # time does not reveal which of the two it was
 
         if not has_credentials:
+            UserModel().set_password(password or "")
             return
 
         # verify password-less login
         try:
             key = SecurityKey.verify_authentication(
-                username, request.session, credential, for_login=True
+                user, request.session, credential, for_login=True
             )
             request.session["webauthn_passwordless"] = key.id
-            return key.user
+            return user
         except Exception:
             raise
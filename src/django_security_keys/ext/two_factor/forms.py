@@ -35,7 +35,7 @@ class SecurityKeyDeviceValidation(forms.Form):
 
         try:
             SecurityKey.verify_authentication(
-                self.device.user.username, self.request.session, credential
+                self.device.user, self.request.session, credential
             )
             self.device.authenticated = True
         except Exception:
@@ -6,6 +6,7 @@ from typing import Any
 import two_factor.views
 from django.contrib.auth import authenticate
 from django.contrib.auth.forms import AuthenticationForm
+from django.contrib.auth.models import User
 from django.core.handlers.wsgi import WSGIRequest
 from django.http.response import HttpResponse, HttpResponseRedirect
 from django.template.response import TemplateResponse
@@ -27,6 +28,38 @@ class LoginView(two_factor.views.LoginView):
         ("security-key", forms.SecurityKeyDeviceValidation),
     )
 
+    def dispatch(self, request: WSGIRequest, *args: Any, **kwargs: Any) -> HttpResponse:
+        # request scoped caches for security key credential and device lookups
+        self._cred_cache = {}
+        self._security_key_devices = {}
+        return super().dispatch(request, *args, **kwargs)
+
+    def _has_credentials(self, user: User, for_login: bool = False) -> bool:
+        """
+        Returns whether the specified user has any security key credentials
+
+        Results are cached for the duration of the request so repeated
+        step condition and context evaluations don't re-query the
+        database.
+        """
+
+        # the key used for password-less login is excluded from the
+        # credentials and may change during the request, so it needs
+        # to be part of the cache key
+
+        cache_key = (
+            user.pk,
+            for_login,
+            self.request.session.get("webauthn_passwordless"),
+        )
+
+        if cache_key not in self._cred_cache:
+            self._cred_cache[cache_key] = SecurityKey.has_credentials(
+                user, self.request.session, for_login=for_login
+            )
+
+        return self._cred_cache[cache_key]
+
     def has_security_key_step(self) -> bool:
         if not self.get_user():
             return False
@@ -37,10 +70,7 @@ class LoginView(two_factor.views.LoginView):
         if token_step_data:
             return False
 
-        return (
-            len(SecurityKey.credentials(self.get_user().username, self.request.session))
-            > 0
-        )
+        return self._has_credentials(self.get_user())
 
     condition_dict = {
         "backup": two_factor.views.LoginView.has_backup_step,
@@ -79,7 +109,11 @@ class LoginView(two_factor.views.LoginView):
             if username and credential:
                 try:
                     user = authenticate(
-                        request, username=username, u2f_credential=credential
+                        request,
+                        username=username,
+                        u2f_credential=SecurityKey.parse_authentication_credential(
+                            credential
+                        ),
                     )
                     self.storage.reset()
                     self.storage.authenticated_user = user
@@ -123,20 +157,24 @@ class LoginView(two_factor.views.LoginView):
         choice if the user has any webauthn devices set up
         """
 
-        if hasattr(self, "_security_key_device"):
-            return self._security_key_device
-
         user = self.get_user()
 
-        if not user or not user.webauthn_security_keys.exists():
+        if not user:
             return None
 
-        device = SecurityKeyDevice.require_for_user(user)
-        device.user = user
+        # cache per user, as the authenticated user can change during
+        # the request (password-less login)
+
+        if user.pk not in self._security_key_devices:
+            device = None
+
+            if self._has_credentials(user):
+                device = SecurityKeyDevice.require_for_user(user)
+                device.user = user
 
-        self._security_key_device = device
+            self._security_key_devices[user.pk] = device
 
-        return device
+        return self._security_key_devices[user.pk]
 
     def get_device(self, step: str | None = None) -> SecurityKeyDevice:
         """
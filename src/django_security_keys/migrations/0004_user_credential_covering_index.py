@@ -0,0 +1,19 @@
+# Generated by Django 4.2.30 on 2026-10-15 21:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("django_security_keys", "0003_date_fields"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="securitykey",
+            index=models.Index(
+                fields=["user", "passwordless_login", "credential_id"],
+                name="sk_user_pwd_covering",
+            ),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 4.2.30 on 2026-10-15 21:45
+
+from django.db import migrations, models
+from webauthn.helpers import base64url_to_bytes
+
+
+BATCH_SIZE = 1000
+
+
+def backfill_raw_public_keys(apps, schema_editor):
+    SecurityKey = apps.get_model("django_security_keys", "SecurityKey")
+
+    # stream the keys and write them back in batches so large tables
+    # are never loaded into memory at once
+
+    qset = SecurityKey.objects.filter(credential_public_key_raw__isnull=True).only(
+        "id", "credential_public_key"
+    )
+    batch = []
+
+    for key in qset.iterator(chunk_size=BATCH_SIZE):
+        key.credential_public_key_raw = base64url_to_bytes(key.credential_public_key)
+        batch.append(key)
+
+        if len(batch) >= BATCH_SIZE:
+            SecurityKey.objects.bulk_update(batch, ["credential_public_key_raw"])
+            batch = []
+
+    if batch:
+        SecurityKey.objects.bulk_update(batch, ["credential_public_key_raw"])
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("django_security_keys", "0004_user_credential_covering_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="securitykey",
+            name="credential_public_key_raw",
+            field=models.BinaryField(null=True),
+        ),
+        migrations.RunPython(backfill_raw_public_keys, migrations.RunPython.noop),
+    ]
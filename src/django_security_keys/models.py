@@ -13,18 +13,29 @@ Ref: https://github.com/duo-labs/py_webauthn
 
 from __future__ import annotations
 
+import functools
+import hmac
+import os
 import secrets
-from typing import Any
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Any, Callable, Iterable, NamedTuple
 
 import webauthn
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.sessions.backends.db import SessionStore
-from django.db import models
+from django.core.signals import setting_changed
+from django.db import IntegrityError, models, transaction
+from django.db.models import Case, F, Value, When
+from django.db.models.functions import Greatest
+from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.functional import SimpleLazyObject
 from django.utils.translation import gettext_lazy as _
 from django_otp.models import Device, ThrottlingMixin
-from webauthn.helpers import base64url_to_bytes, bytes_to_base64url
 from webauthn.helpers.structs import (
     AuthenticationCredential,
     PublicKeyCredentialDescriptor,
@@ -32,6 +43,113 @@ from webauthn.helpers.structs import (
 )
 
 
+def _base64url_to_bytes(value: str) -> bytes:
+    """
+    Decodes an unpadded base64url string, pads exactly as needed
+    """
+
+    return urlsafe_b64decode(value + "=" * (-len(value) % 4))
+
+
+def _bytes_to_base64url(value: bytes) -> str:
+    """
+    Encodes bytes to an unpadded base64url string
+    """
+
+    return urlsafe_b64encode(value).rstrip(b"=").decode("ascii")
+
+
+# security key fields required to verify an authentication attempt
+
+_VERIFICATION_FIELDS = (
+    "id",
+    "user",
+    "credential_id",
+    "credential_public_key_raw",
+    "sign_count",
+    "passwordless_login",
+)
+
+# webauthn signature verification is cpu bound and happens in native code
+# that releases the GIL, so it is run in a shared thread pool instead of
+# blocking the request thread
+
+_verify_pool = ThreadPoolExecutor(
+    max_workers=os.cpu_count(), thread_name_prefix="webauthn-verify"
+)
+
+
+class WebauthnSettings(NamedTuple):
+    rp_id: str
+    rp_name: str
+    origin: str
+    attestation: str
+    verify_timeout: float
+
+
+@functools.lru_cache(maxsize=1)
+def webauthn_settings() -> WebauthnSettings:
+    """
+    Returns the `WEBAUTHN_*` django settings
+
+    These are read on every webauthn registration and authentication,
+    so they are cached until a webauthn setting changes.
+    """
+
+    return WebauthnSettings(
+        rp_id=settings.WEBAUTHN_RP_ID,
+        rp_name=settings.WEBAUTHN_RP_NAME,
+        origin=settings.WEBAUTHN_ORIGIN,
+        attestation=getattr(settings, "WEBAUTHN_ATTESTATION", "none"),
+        verify_timeout=getattr(settings, "WEBAUTHN_VERIFY_TIMEOUT", 5),
+    )
+
+
+@receiver(setting_changed)
+def _clear_webauthn_settings(setting: str, **kwargs: Any) -> None:
+    if setting.startswith("WEBAUTHN_"):
+        webauthn_settings.cache_clear()
+
+
+def _run_verification(fn: Callable, **kwargs: Any) -> Any:
+    """
+    Runs a py_webauthn verification function in the verification
+    thread pool and waits for the result
+
+    The timeout includes the time the job waits in the pool queue, a job
+    that times out before it started is cancelled so it does not hold up
+    later verifications.
+    """
+
+    future = _verify_pool.submit(fn, **kwargs)
+    try:
+        return future.result(timeout=webauthn_settings().verify_timeout)
+    except FutureTimeoutError:
+        future.cancel()
+        raise
+
+
+def _match_credential(
+    keys: Iterable[SecurityKey], credential_id: str
+) -> SecurityKey | None:
+    """
+    Returns the security key matching the credential id
+
+    All keys are compared in constant time and without returning
+    early, so the time taken does not reveal how much of a credential
+    id matched.
+    """
+
+    match = None
+    credential_id = credential_id.encode()
+
+    for key in keys:
+        if hmac.compare_digest(key.credential_id.encode(), credential_id):
+            match = key
+
+    return match
+
+
 class UserHandle(models.Model):
 
     """
@@ -84,19 +202,27 @@ class UserHandle(models.Model):
         except UserHandle.DoesNotExist:
             pass
 
-        handle = secrets.token_urlsafe(32)
+        # a collision on 32 random bytes is extremely unlikely, so instead
+        # of checking for an existing handle before every insert rely on
+        # the unique constraint and retry on the rare conflict
+
         max_tries = 1000
-        tries = 0
 
-        while cls.objects.filter(handle=handle).exists():
-            handle = secrets.token_urlsafe(32)
-            if tries >= max_tries:
-                raise ValueError(
-                    _("Unable to generate unique user handle for webauthn")
-                )
-            tries += 1
+        for _tries in range(max_tries):
+            try:
+                with transaction.atomic():
+                    return cls.objects.create(
+                        user=user, handle=secrets.token_urlsafe(32)
+                    )
+            except IntegrityError:
+                # handle may have been created for the user concurrently
 
-        return cls.objects.create(user=user, handle=handle)
+                try:
+                    return cls.objects.get(user=user)
+                except cls.DoesNotExist:
+                    pass
+
+        raise ValueError(_("Unable to generate unique user handle for webauthn"))
 
 
 class SecurityKey(models.Model):
@@ -114,6 +240,18 @@ class SecurityKey(models.Model):
         verbose_name = _("Webauthn Security Key")
         verbose_name_plural = _("Webauthn Security Keys")
 
+        indexes = [
+            # serves credential lookups for both two-factor and
+            # password-less login from the index alone.
+            #
+            # credential_id is a trailing key column rather than an included
+            # column since those are only supported on postgresql
+            models.Index(
+                fields=["user", "passwordless_login", "credential_id"],
+                name="sk_user_pwd_covering",
+            ),
+        ]
+
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL,
         related_name="webauthn_security_keys",
@@ -123,6 +261,12 @@ class SecurityKey(models.Model):
     name = models.CharField(max_length=255, null=True, help_text=_("Security key name"))
     credential_id = models.CharField(max_length=255, unique=True, db_index=True)
     credential_public_key = models.TextField()
+
+    # raw bytes of the public key as returned at registration, used for
+    # verification so it does not need to be base64 decoded on every
+    # authentication
+
+    credential_public_key_raw = models.BinaryField(null=True)
     sign_count = models.PositiveIntegerField(default=0)
     attestation = models.TextField(
         null=True, blank=True, help_text=_("Attestation information")
@@ -149,7 +293,7 @@ class SecurityKey(models.Model):
         - session: django request session
         - challenge (`bytes`): byte string
         """
-        session["webauthn_challenge"] = bytes_to_base64url(challenge)
+        session["webauthn_challenge"] = _bytes_to_base64url(challenge)
 
     @classmethod
     def get_challenge(cls, session: SessionStore) -> bytes:
@@ -165,7 +309,7 @@ class SecurityKey(models.Model):
         - `bytes` challenge string
         """
 
-        return base64url_to_bytes(session["webauthn_challenge"])
+        return _base64url_to_bytes(session["webauthn_challenge"])
 
     @classmethod
     def clear_challenge(cls, session: SessionStore) -> None:
@@ -177,10 +321,7 @@ class SecurityKey(models.Model):
         - session: django request session
         """
 
-        try:
-            del session["webauthn_challenge"]
-        except KeyError:
-            pass
+        session.pop("webauthn_challenge", None)
 
     @classmethod
     def generate_registration(cls, user: User, session: SessionStore) -> str:
@@ -198,12 +339,14 @@ class SecurityKey(models.Model):
         - `str` JSON string
         """
 
+        conf = webauthn_settings()
+
         opts = webauthn.generate_registration_options(
-            rp_id=settings.WEBAUTHN_RP_ID,
-            rp_name=settings.WEBAUTHN_RP_NAME,
+            rp_id=conf.rp_id,
+            rp_name=conf.rp_name,
             user_id=UserHandle.require_for_user(user).handle,
             user_name=user.username,
-            attestation=getattr(settings, "WEBAUTHN_ATTESTATION", "none"),
+            attestation=conf.attestation,
         )
 
         cls.set_challenge(session, opts.challenge)
@@ -251,34 +394,45 @@ class SecurityKey(models.Model):
 
         # verify the credentials
 
-        verified_registration = webauthn.verify_registration_response(
+        conf = webauthn_settings()
+
+        verified_registration = _run_verification(
+            webauthn.verify_registration_response,
             credential=credential,
             expected_challenge=challenge,
-            expected_rp_id=settings.WEBAUTHN_RP_ID,
-            expected_origin=settings.WEBAUTHN_ORIGIN,
+            expected_rp_id=conf.rp_id,
+            expected_origin=conf.origin,
         )
 
         # challenge clean up
         cls.clear_challenge(session)
 
-        # create security key
-        key = cls.objects.create(
-            user=user,
-            credential_id=bytes_to_base64url(verified_registration.credential_id),
-            credential_public_key=bytes_to_base64url(
-                verified_registration.credential_public_key
-            ),
-            sign_count=verified_registration.sign_count,
-            name=kwargs.get("name", "main"),
-            passwordless_login=kwargs.get("passwordless_login", False),
-            attestation=bytes_to_base64url(verified_registration.attestation_object),
-            type="security-key",
-        )
+        # write the security key and the two-factor device in a single
+        # transaction
+
+        with transaction.atomic():
+            # create security key
+            key = cls.objects.create(
+                user=user,
+                credential_id=_bytes_to_base64url(verified_registration.credential_id),
+                credential_public_key=_bytes_to_base64url(
+                    verified_registration.credential_public_key
+                ),
+                credential_public_key_raw=verified_registration.credential_public_key,
+                sign_count=verified_registration.sign_count,
+                name=kwargs.get("name", "main"),
+                passwordless_login=kwargs.get("passwordless_login", False),
+                attestation=_bytes_to_base64url(
+                    verified_registration.attestation_object
+                ),
+                type="security-key",
+            )
+
+            # create django-two-factor device for security keys so
+            # they become in option in the 2FA process.
 
-        # create django-two-factor device for security keys so
-        # they become in option in the 2FA process.
+            SecurityKeyDevice.require_for_user(user)
 
-        SecurityKeyDevice.require_for_user(user)
         return key
 
     @classmethod
@@ -291,21 +445,42 @@ class SecurityKey(models.Model):
         - session: request session
         """
 
-        try:
-            del session["webauthn_passwordless"]
-        except KeyError:
-            pass
+        session.pop("webauthn_passwordless", None)
 
     @classmethod
-    def credentials(
+    def for_user(cls, username: User | str) -> models.QuerySet:
+        """
+        Returns a queryset of all security keys for the specified username
+
+        Arguments:
+
+        - username (`str`|`User`): username or django user instance, passing
+          the user instance avoids a join on the user table
+
+        Returns:
+
+        - `QuerySet<SecurityKey>`
+        """
+
+        if isinstance(username, str):
+            return cls.objects.filter(user__username=username)
+        return cls.objects.filter(user=username)
+
+    @classmethod
+    def credentials_qs(
         cls, username: User | str, session: SessionStore, for_login: bool = False
-    ) -> list[PublicKeyCredentialDescriptor]:
+    ) -> models.QuerySet:
         """
-        Returns a list of credentials for the specified username
+        Returns a queryset of the security keys that are eligible
+        as credentials for the specified username
+
+        Use this if you only need to check for existence of credentials
+        (`.exists()`) to avoid materializing the credential list.
 
         Arguments:
 
-        - username (`str`)
+        - username (`str`|`User`): username or django user instance, passing
+          the user instance avoids a join on the user table
         - session: django request session
         - for_login (`bool`=False): if True indicates that the
           credentials are to be used for password-less login.
@@ -315,10 +490,10 @@ class SecurityKey(models.Model):
 
         Returns:
 
-        - `list<PublicKeyCredentialDescriptor>`
+        - `QuerySet<SecurityKey>`
         """
 
-        qset = cls.objects.filter(user__username=username)
+        qset = cls.for_user(username)
 
         # if a security key was used for passwordless auth
         # it should not be available for two factor auth
@@ -332,12 +507,64 @@ class SecurityKey(models.Model):
         if for_login:
             qset = qset.filter(passwordless_login=True)
 
+        return qset
+
+    @classmethod
+    def has_credentials(
+        cls, username: User | str, session: SessionStore, for_login: bool = False
+    ) -> bool:
+        """
+        Returns whether there are any credentials for the specified username
+
+        Cheaper than checking the result of `credentials` as no credential
+        descriptors need to be built.
+
+        Arguments:
+
+        - username (`str`|`User`): username or django user instance
+        - session: django request session
+        - for_login (`bool`=False): check for password-less login credentials
+
+        Returns:
+
+        - `bool`
+        """
+
+        return cls.credentials_qs(username, session, for_login=for_login).exists()
+
+    @classmethod
+    def credentials(
+        cls, username: User | str, session: SessionStore, for_login: bool = False
+    ) -> list[PublicKeyCredentialDescriptor]:
+        """
+        Returns a list of credentials for the specified username
+
+        Arguments:
+
+        - username (`str`|`User`): username or django user instance
+        - session: django request session
+        - for_login (`bool`=False): if True indicates that the
+          credentials are to be used for password-less login.
+
+          if False indicates that the credentials are to be used
+          as a two-factor step
+
+        Returns:
+
+        - `list<PublicKeyCredentialDescriptor>`
+        """
+
+        qset = cls.credentials_qs(username, session, for_login=for_login)
+
+        # only the credential id is needed to build the descriptors, it is
+        # part of the user index so this can be served by an index only scan
+
         return [
             PublicKeyCredentialDescriptor(
                 type="public-key",
-                id=base64url_to_bytes(key.credential_id),
+                id=_base64url_to_bytes(credential_id),
             )
-            for key in qset
+            for credential_id in qset.values_list("credential_id", flat=True)
         ]
 
     @classmethod
@@ -361,7 +588,7 @@ class SecurityKey(models.Model):
         """
 
         opts = webauthn.generate_authentication_options(
-            rp_id=settings.WEBAUTHN_RP_ID,
+            rp_id=webauthn_settings().rp_id,
             allow_credentials=cls.credentials(username, session, for_login=for_login),
         )
 
@@ -369,23 +596,51 @@ class SecurityKey(models.Model):
 
         return webauthn.options_to_json(opts)
 
+    @classmethod
+    def parse_authentication_credential(
+        cls, raw_credential: str | AuthenticationCredential
+    ) -> AuthenticationCredential:
+        """
+        Parses a webauthn authentication credential
+
+        Parse the credential once with this if it is handed to multiple
+        places (e.g., `authenticate`) to avoid parsing it again each time.
+
+        Arguments:
+
+        - raw_credential (`str`|`AuthenticationCredential`): JSON formatted
+          PublicKeyCredential as returned from `navigator.credentials.get`,
+          already parsed credentials are returned as is
+
+        Returns:
+
+        - `AuthenticationCredential`
+        """
+
+        if isinstance(raw_credential, AuthenticationCredential):
+            return raw_credential
+        return AuthenticationCredential.parse_raw(raw_credential)
+
     @classmethod
     def verify_authentication(
         cls,
-        username: str,
+        username: User | str,
         session: SessionStore,
-        raw_credential: str,
+        raw_credential: str | AuthenticationCredential,
         for_login: bool = False,
     ) -> SecurityKey:
         """
         Verify the webauthn authentication
 
+        The security key needs to belong to the specified user.
+
         Arguments:
 
-        - username (`str`)
+        - username (`str`|`User`): username or django user instance
         - session: django request session
-        - raw_credentials (`str`): JSON formatted PublicKeyCredential as returned
-          from `navigator.credentials.get`
+        - raw_credentials (`str`|`AuthenticationCredential`): JSON formatted
+          PublicKeyCredential as returned from `navigator.credentials.get`,
+          or the already parsed credential
         - for_login: (`bool`=False): verify a password-less login attempt
 
         Returns:
@@ -402,24 +657,39 @@ class SecurityKey(models.Model):
 
         # parse credential
 
-        credential = AuthenticationCredential.parse_raw(raw_credential)
+        credential = cls.parse_authentication_credential(raw_credential)
 
-        try:
-            key = cls.objects.get(credential_id=credential.id)
-        except SecurityKey.DoesNotExist:
+        # only load the fields needed for verification, the attestation
+        # payload is never used here
+
+        qset = cls.for_user(username).only(*_VERIFICATION_FIELDS)
+
+        if isinstance(username, str):
+            # user is joined through the username lookup anyway
+            qset = qset.select_related("user")
+
+        key = _match_credential(qset, credential.id)
+
+        if key is None:
             raise ValueError(_("Security key authentication failed"))
 
+        if not isinstance(username, str):
+            key.user = username
+
         if for_login and not key.passwordless_login:
             raise ValueError(_("Security key not enabled for password-less login"))
 
         # verify authentication
 
-        verified_authentication = webauthn.verify_authentication_response(
+        conf = webauthn_settings()
+
+        verified_authentication = _run_verification(
+            webauthn.verify_authentication_response,
             credential=credential,
             expected_challenge=challenge,
-            expected_rp_id=settings.WEBAUTHN_RP_ID,
-            expected_origin=settings.WEBAUTHN_ORIGIN,
-            credential_public_key=base64url_to_bytes(key.credential_public_key),
+            expected_rp_id=conf.rp_id,
+            expected_origin=conf.origin,
+            credential_public_key=key.public_key_bytes,
             credential_current_sign_count=key.sign_count,
         )
 
@@ -427,13 +697,175 @@ class SecurityKey(models.Model):
 
         cls.clear_challenge(session)
 
-        # update sign count
+        # update sign count, targeted update so the rest of the row
+        # does not need to be rewritten.
+        #
+        # the sign count condition makes sure a concurrent authentication
+        # that already stored a higher sign count is never rolled back
 
         key.sign_count = verified_authentication.new_sign_count
-        key.save()
+        key.updated = timezone.now()
+        cls.objects.filter(pk=key.pk, sign_count__lte=key.sign_count).update(
+            sign_count=key.sign_count, updated=key.updated
+        )
 
         return key
 
+    @classmethod
+    async def averify_authentication(
+        cls,
+        username: User | str,
+        session: SessionStore,
+        raw_credential: str | AuthenticationCredential,
+        for_login: bool = False,
+    ) -> SecurityKey:
+        """
+        Async version of `verify_authentication`
+
+        Database access happens through `sync_to_async` and the signature
+        verification in the verification thread pool, so the event loop
+        is never blocked.
+        """
+
+        return await sync_to_async(cls.verify_authentication)(
+            username, session, raw_credential, for_login=for_login
+        )
+
+    @classmethod
+    def verify_authentication_batch(
+        cls,
+        username: User | str,
+        session: SessionStore,
+        raw_credentials: list[str | AuthenticationCredential],
+        for_login: bool = False,
+    ) -> list[SecurityKey]:
+        """
+        Verify multiple webauthn authentications against the session's
+        challenge at once
+
+        All keys are fetched in one query, the assertions are verified
+        concurrently and the sign counts are updated in one query.
+
+        Verification fails as a whole if any of the credentials fail or
+        no credentials are supplied.
+
+        Arguments:
+
+        - username (`str`|`User`): username or django user instance
+        - session: django request session
+        - raw_credentials (`list<str|AuthenticationCredential>`): JSON formatted
+          PublicKeyCredentials as returned from `navigator.credentials.get`,
+          or the already parsed credentials
+        - for_login: (`bool`=False): verify password-less login attempts
+
+        Returns:
+
+        - `list<SecurityKey>`: security key instances in the order of the
+          supplied credentials
+        """
+
+        # an empty batch must not pass as a successful authentication
+
+        if not raw_credentials:
+            raise ValueError(_("No security key credentials supplied"))
+
+        # get webauthn challenge from session
+
+        try:
+            challenge = cls.get_challenge(session)
+        except KeyError:
+            raise ValueError(_("Invalid webauthn challenge"))
+
+        # parse credentials
+
+        credentials = [
+            cls.parse_authentication_credential(raw_credential)
+            for raw_credential in raw_credentials
+        ]
+        credential_ids = [credential.id for credential in credentials]
+
+        if len(set(credential_ids)) != len(credential_ids):
+            raise ValueError(_("Duplicate security key credentials"))
+
+        user_keys = list(cls.for_user(username).only(*_VERIFICATION_FIELDS))
+        keys = {}
+
+        for credential_id in credential_ids:
+            key = _match_credential(user_keys, credential_id)
+
+            if key is None:
+                raise ValueError(_("Security key authentication failed"))
+
+            keys[credential_id] = key
+
+        if for_login and not all(key.passwordless_login for key in keys.values()):
+            raise ValueError(_("Security key not enabled for password-less login"))
+
+        conf = webauthn_settings()
+
+        def verify(credential: AuthenticationCredential):
+            key = keys[credential.id]
+            return webauthn.verify_authentication_response(
+                credential=credential,
+                expected_challenge=challenge,
+                expected_rp_id=conf.rp_id,
+                expected_origin=conf.origin,
+                credential_public_key=key.public_key_bytes,
+                credential_current_sign_count=key.sign_count,
+            )
+
+        # verify authentications
+
+        verified_authentications = list(
+            _verify_pool.map(verify, credentials, timeout=conf.verify_timeout)
+        )
+
+        # clear challenge
+
+        cls.clear_challenge(session)
+
+        # update sign counts
+
+        now = timezone.now()
+        for credential, verified_authentication in zip(
+            credentials, verified_authentications
+        ):
+            key = keys[credential.id]
+            key.sign_count = verified_authentication.new_sign_count
+            key.updated = now
+
+        # single UPDATE for all keys, like the single key update a stored
+        # sign count that is already higher is never rolled back
+
+        cls.objects.filter(pk__in=[key.pk for key in keys.values()]).update(
+            sign_count=Greatest(
+                F("sign_count"),
+                Case(
+                    *[
+                        When(pk=key.pk, then=Value(key.sign_count))
+                        for key in keys.values()
+                    ],
+                    output_field=models.PositiveIntegerField(),
+                ),
+            ),
+            updated=now,
+        )
+
+        return [keys[credential_id] for credential_id in credential_ids]
+
+    @property
+    def public_key_bytes(self) -> bytes:
+        """
+        Returns the credential public key as bytes
+
+        Keys registered before the raw value was stored will have
+        it decoded from the base64 value instead.
+        """
+
+        if self.credential_public_key_raw is not None:
+            return bytes(self.credential_public_key_raw)
+        return _base64url_to_bytes(self.credential_public_key)
+
 
 class SecurityKeyDevice(ThrottlingMixin, Device):
     """
@@ -450,10 +882,10 @@ class SecurityKeyDevice(ThrottlingMixin, Device):
 
     @classmethod
     def require_for_user(cls, user: User) -> SecurityKeyDevice:
-        try:
-            return cls.objects.get(user=user)
-        except cls.DoesNotExist:
-            return cls.objects.create(user=user, name="security-keys")
+        device, _created = cls.objects.get_or_create(
+            user=user, defaults={"name": "security-keys"}
+        )
+        return device
 
     @property
     def method(self) -> str:
@@ -1,35 +1,100 @@
 from __future__ import annotations
 
+import functools
 import json
 from typing import Any
 
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.contrib.auth import authenticate, login, logout
+from django.contrib.auth import authenticate, get_user_model, login, logout
 from django.contrib.auth.decorators import login_required
+from django.contrib.auth.models import User
 from django.core.handlers.wsgi import WSGIRequest
-from django.db import transaction
-from django.http import JsonResponse
-from django.http.response import HttpResponse, HttpResponseRedirect
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.http.response import (
+    HttpResponse,
+    HttpResponseNotAllowed,
+    HttpResponseRedirect,
+)
 from django.shortcuts import redirect, render
-from django.urls import reverse
+from django.urls import get_script_prefix, get_urlconf, reverse
 from django.utils.http import url_has_allowed_host_and_scheme
 from django.utils.translation import gettext_lazy as _
+from django.views.decorators.http import require_POST
 
 from django_security_keys.forms import LoginForm, RegisterKeyForm
 from django_security_keys.models import SecurityKey
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-def convert_to_bool(data: bool) -> bool:
-    if data is None:
-        return False
 
-    if isinstance(data, bool):
-        return data
+_LOGIN_TEMPLATE = "django-security-keys/login.html"
 
-    if isinstance(data, str):
-        return data.lower() == "true"
 
-    return False
+@functools.lru_cache(maxsize=None)
+def _cached_reverse(viewname: str, urlconf: str | None, prefix: str) -> str:
+    return reverse(viewname, urlconf=urlconf)
+
+
+def _reverse(viewname: str) -> str:
+    """
+    Returns the url for a view name without arguments, resolved once
+    per url configuration and script prefix
+    """
+
+    return _cached_reverse(viewname, get_urlconf(), get_script_prefix())
+
+
+@receiver(setting_changed)
+def _clear_reverse(setting: str, **kwargs: Any) -> None:
+    if setting == "ROOT_URLCONF":
+        _cached_reverse.cache_clear()
+
+
+def _get_user(username: str) -> User | None:
+    UserModel = get_user_model()
+    return UserModel._default_manager.filter(
+        **{UserModel.USERNAME_FIELD: username}
+    ).first()
+
+
+# unbound registration form carries no request state, so the same
+# instance can be used to render every manage-keys page
+
+_EMPTY_REGISTER_FORM = RegisterKeyForm()
+
+
+def _json_response(data: Any, status: int = 200) -> HttpResponse:
+    """
+    Returns a JSON response, serialized with orjson if it is installed
+    """
+
+    if orjson:
+        # default=str takes care of lazy translation strings
+        content = orjson.dumps(data, default=str)
+    else:
+        content = json.dumps(data, cls=DjangoJSONEncoder)
+
+    return HttpResponse(content, status=status, content_type="application/json")
+
+
+# body of the plain status-ok responses, serialized once
+
+_OK_JSON = b'{"status": "ok"}'
+
+
+def _ok_response() -> HttpResponse:
+    return HttpResponse(_OK_JSON, content_type="application/json")
+
+
+# POST values (lower-cased) that enable a boolean option
+
+_TRUE_VALUES = frozenset({"true", "on", "1"})
 
 
 def basic_logout(request: WSGIRequest) -> HttpResponseRedirect:
@@ -39,7 +104,7 @@ def basic_logout(request: WSGIRequest) -> HttpResponseRedirect:
     """
 
     logout(request)
-    return redirect(reverse("login"))
+    return redirect(_reverse("login"))
 
 
 def basic_login(request: WSGIRequest) -> HttpResponse | HttpResponseRedirect:
@@ -62,11 +127,25 @@ def basic_login(request: WSGIRequest) -> HttpResponse | HttpResponseRedirect:
             credential = request.POST.get("credential")
 
             if credential:
-                # credential is set, provide it in the authenticate request
-
-                user = authenticate(
-                    request, username=username, u2f_credential=credential
-                )
+                # credential is set, parse it once and provide it in the
+                # authenticate request
+                #
+                # the user is resolved here so the password-less backend
+                # can reuse it
+
+                try:
+                    credential = SecurityKey.parse_authentication_credential(credential)
+                except ValueError:
+                    # malformed credential (pydantic's ValidationError is
+                    # a ValueError), fail like any other authentication
+
+                    user = None
+                else:
+                    request._prefetched_user = _get_user(username)
+
+                    user = authenticate(
+                        request, username=username, u2f_credential=credential
+                    )
             else:
                 # no credential, attempt to do a normal login with name and password
 
@@ -90,12 +169,10 @@ def basic_login(request: WSGIRequest) -> HttpResponse | HttpResponseRedirect:
                 # authentication failure
 
                 form.add_error("__all__", "Invalid username / password")
-
-        return render(request, "django-security-keys/login.html", {"form": form})
     else:
         form = LoginForm()
 
-    return render(request, "django-security-keys/login.html", {"form": form})
+    return render(request, _LOGIN_TEMPLATE, {"form": form})
 
 
 @login_required
@@ -105,23 +182,26 @@ def manage_keys(request: WSGIRequest) -> HttpResponse:
     of their keys and a form to register new keys.
     """
 
-    context = {"form": RegisterKeyForm()}
+    context = {"form": _EMPTY_REGISTER_FORM}
     return render(request, "django-security-keys/manage-keys.html", context)
 
 
 @login_required
-def request_registration(request: WSGIRequest, **kwargs: Any) -> JsonResponse:
+def request_registration(request: WSGIRequest, **kwargs: Any) -> HttpResponse:
     """
     Requests webauthn registration options from the server
     as a JSON response
     """
 
-    return JsonResponse(
-        json.loads(SecurityKey.generate_registration(request.user, request.session))
+    # options are already JSON encoded and can be returned as is
+
+    return HttpResponse(
+        SecurityKey.generate_registration(request.user, request.session),
+        content_type="application/json",
     )
 
 
-def request_authentication(request: WSGIRequest, **kwargs: Any) -> JsonResponse:
+async def request_authentication(request: WSGIRequest, **kwargs: Any) -> HttpResponse:
     """
     Requests webauthn authentications options from the server
     as a JSON response
@@ -129,24 +209,31 @@ def request_authentication(request: WSGIRequest, **kwargs: Any) -> JsonResponse:
     Expects a `username` POST parameter
     """
 
+    # require_POST does not support coroutine views before django 5
+
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+
     username = request.POST.get("username")
     for_login = request.POST.get("for_login")
 
     if not username:
-        return JsonResponse({"non_field_errors": _("No username supplied")}, status=403)
-
-    return JsonResponse(
-        json.loads(
-            SecurityKey.generate_authentication(
-                username, request.session, for_login=for_login
-            )
+        return _json_response(
+            {"non_field_errors": _("No username supplied")}, status=403
         )
+
+    options = await sync_to_async(SecurityKey.generate_authentication)(
+        username, request.session, for_login=for_login
     )
 
+    # options are already JSON encoded and can be returned as is
+
+    return HttpResponse(options, content_type="application/json")
 
+
+@require_POST
 @login_required
-@transaction.atomic
-def register_security_key(request: WSGIRequest, **kwargs: Any) -> JsonResponse:
+def register_security_key(request: WSGIRequest, **kwargs: Any) -> HttpResponse:
     """
     Register a webauthn security key.
 
@@ -161,7 +248,9 @@ def register_security_key(request: WSGIRequest, **kwargs: Any) -> JsonResponse:
 
     name = request.POST.get("name", "security-key")
     credential = request.POST.get("credential")
-    passwordless_login = convert_to_bool(request.POST.get("passwordless_login", False))
+    passwordless_login = (
+        request.POST.get("passwordless_login", "").lower() in _TRUE_VALUES
+    )
 
     security_key = SecurityKey.verify_registration(
         request.user,
@@ -171,13 +260,12 @@ def register_security_key(request: WSGIRequest, **kwargs: Any) -> JsonResponse:
         passwordless_login=passwordless_login,
     )
 
-    return JsonResponse(
+    return _json_response(
         {"status": "ok", "name": security_key.name, "id": security_key.id}
     )
 
 
 @login_required
-@transaction.atomic
 def register_security_key_form(
     request: WSGIRequest, **kwargs: Any
 ) -> HttpResponseRedirect:
@@ -203,14 +291,13 @@ def register_security_key_form(
             name=form.cleaned_data["name"] or "security-key",
             passwordless_login=form.cleaned_data["passwordless_login"],
         )
-        return redirect(reverse("security-keys:manage-keys"))
+        return redirect(_reverse("security-keys:manage-keys"))
     else:
         context = {"form": form}
         return render(request, "django-security-keys/manage-keys.html", context)
 
 
-@transaction.atomic
-def verify_authentication(request: WSGIRequest) -> JsonResponse:
+async def verify_authentication(request: WSGIRequest) -> HttpResponse:
     """
     Verify the authentication attempt.
 
@@ -233,30 +320,49 @@ def verify_authentication(request: WSGIRequest) -> JsonResponse:
 
     """
 
+    # require_POST does not support coroutine views before django 5
+
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+
     credential = request.POST.get("credential")
     username = request.POST.get("username")
 
     try:
-        SecurityKey.verify_authentication(
+        await SecurityKey.averify_authentication(
             username,
             request.session,
             credential,
             for_login=(request.POST.get("auth_type") == "login"),
         )
     except Exception:
-        return JsonResponse(
+        return _json_response(
             {"non_field_errors": "Security authentication failed"}, status=403
         )
 
-    return JsonResponse(
-        {
-            "status": "ok",
-        }
-    )
+    return _ok_response()
+
+
+def _delete_security_key(request: WSGIRequest) -> int:
+    """
+    Deletes the security key specified by the `id` POST parameter if it
+    belongs to the requesting user
+
+    Deletes directly, no need to load the key first.
 
+    Returns the number of deleted keys
+    """
+
+    deleted, _deleted_per_model = SecurityKey.objects.filter(
+        pk=request.POST.get("id"), user=request.user
+    ).delete()
+
+    return deleted
 
+
+@require_POST
 @login_required
-def remove_security_key(request: WSGIRequest, **kwargs: Any) -> JsonResponse:
+def remove_security_key(request: WSGIRequest, **kwargs: Any) -> HttpResponse:
     """
     Decommission a security key.
 
@@ -269,19 +375,10 @@ def remove_security_key(request: WSGIRequest, **kwargs: Any) -> JsonResponse:
     Returns a JSON response
     """
 
-    id = request.POST.get("id")
+    if not _delete_security_key(request):
+        return _json_response({"non_field_errors": [_("Key not found")]}, status=404)
 
-    try:
-        sec_key = request.user.webauthn_security_keys.get(pk=id)
-    except SecurityKey.DoesNotExist:
-        return JsonResponse({"non_field_errors": [_("Key not found")]}, status=404)
-    sec_key.delete()
-
-    return JsonResponse(
-        {
-            "status": "ok",
-        }
-    )
+    return _ok_response()
 
 
 @login_required
@@ -300,6 +397,6 @@ def remove_security_key_form(
     Returns a redirect response to manage-keys
     """
 
-    remove_security_key(request, **kwargs)
+    _delete_security_key(request)
 
-    return redirect(reverse("security-keys:manage-keys"))
+    return redirect(_reverse("security-keys:manage-keys"))
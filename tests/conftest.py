@@ -1,2 +1 @@
-import tests.project.settings  # noqa
 from tests.fixtures import *  # noqa
@@ -99,6 +99,15 @@ DATABASES = {
 }
 
 
+# Sessions
+# https://docs.djangoproject.com/en/3.2/topics/http/sessions/#configuring-sessions
+#
+# cache backed sessions (local memory cache) so creating a session in the tests
+# does not write to the database
+
+SESSION_ENGINE = "django.contrib.sessions.backends.cache"
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -118,6 +127,13 @@ AUTH_PASSWORD_VALIDATORS = [
 ]
 
 
+# fast password hashing for the tests
+
+PASSWORD_HASHERS = [
+    "django.contrib.auth.hashers.MD5PasswordHasher",
+]
+
+
 # Internationalization
 # https://docs.djangoproject.com/en/3.2/topics/i18n/
 
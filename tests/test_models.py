@@ -1,17 +1,78 @@
 import json
 import secrets
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from types import SimpleNamespace
 
 import pytest
+from asgiref.sync import async_to_sync
+from django.test import override_settings
+from webauthn.helpers import base64url_to_bytes
 
+from django_security_keys import models
 from django_security_keys.models import SecurityKey, UserHandle
 
 
+@pytest.mark.parametrize("length", range(6))
+def test_base64url(length):
+    value = secrets.token_bytes(length)
+    encoded = models._bytes_to_base64url(value)
+
+    assert "=" not in encoded
+    assert models._base64url_to_bytes(encoded) == value
+    assert base64url_to_bytes(encoded) == value
+
+
+def test_webauthn_settings():
+    assert models.webauthn_settings().rp_id == "localhost"
+
+    with override_settings(WEBAUTHN_RP_ID="example.com"):
+        assert models.webauthn_settings().rp_id == "example.com"
+
+    assert models.webauthn_settings().rp_id == "localhost"
+
+
+def test_run_verification_timeout_cancels(monkeypatch):
+    pool = ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr(models, "_verify_pool", pool)
+
+    # occupy the only worker so the verification stays queued
+
+    release = threading.Event()
+    pool.submit(release.wait)
+
+    called = []
+
+    with override_settings(WEBAUTHN_VERIFY_TIMEOUT=0.01):
+        with pytest.raises(FutureTimeoutError):
+            models._run_verification(lambda: called.append(True))
+
+    release.set()
+    pool.shutdown(wait=True)
+
+    assert not called
+
+
 @pytest.mark.django_db
 def test_user_handle_require_for_user(user):
     UserHandle.require_for_user(user)
     assert user.webauthn_user_handle
 
 
+@pytest.mark.django_db
+def test_user_handle_require_for_user_collision(user, monkeypatch):
+    from django.contrib.auth import get_user_model
+
+    other = get_user_model().objects.create_user("alice", password="user")
+    UserHandle.objects.create(user=other, handle="taken")
+
+    handles = iter(["taken", "free"])
+    monkeypatch.setattr(secrets, "token_urlsafe", lambda n: next(handles))
+
+    assert UserHandle.require_for_user(user).handle == "free"
+
+
 @pytest.mark.django_db
 def test_security_key_challenge(user, session):
     SecurityKey.set_challenge(session, secrets.token_bytes(16))
@@ -51,6 +112,16 @@ def test_security_key_verify_registration(test_credential):
         SecurityKey.get_challenge(session)
 
 
+@pytest.mark.django_db
+def test_security_key_verify_registration_invalid(invalid_test_credential):
+    user, session, credential = invalid_test_credential
+
+    with pytest.raises(Exception):
+        SecurityKey.verify_registration(user, session, credential)
+
+    assert not SecurityKey.objects.filter(user=user).exists()
+
+
 @pytest.mark.django_db
 def test_security_key_credentials(security_key):
     user, session, key = security_key
@@ -66,6 +137,32 @@ def test_security_key_credentials_passwordless(security_key_passwordless):
     assert len(SecurityKey.credentials(user.username, session)) == 1
     assert len(SecurityKey.credentials(user.username, session, for_login=True)) == 1
 
+    # user instance instead of username
+
+    assert len(SecurityKey.credentials(user, session)) == 1
+    assert len(SecurityKey.credentials(user, session, for_login=True)) == 1
+
+
+@pytest.mark.django_db
+def test_security_key_credentials_qs(security_key_passwordless):
+    user, session, key = security_key_passwordless
+
+    assert SecurityKey.credentials_qs(user.username, session).exists()
+    assert SecurityKey.credentials_qs(user.username, session, for_login=True).exists()
+
+    # key used for password-less login is not available for 2FA
+
+    session["webauthn_passwordless"] = key.id
+    assert not SecurityKey.credentials_qs(user.username, session).exists()
+
+
+@pytest.mark.django_db
+def test_security_key_has_credentials(security_key):
+    user, session, key = security_key
+
+    assert SecurityKey.has_credentials(user, session)
+    assert not SecurityKey.has_credentials(user, session, for_login=True)
+
 
 @pytest.mark.django_db
 def test_security_key_generate_authentication(user, session):
@@ -88,6 +185,93 @@ def test_security_key_verify_authentication(test_auth_credential):
     key = SecurityKey.verify_authentication(user.username, session, cred)
     assert key
 
+    key.refresh_from_db()
+    assert key.sign_count == 1
+
+
+@pytest.mark.django_db
+def test_match_credential(security_key):
+    user, session, key = security_key
+
+    keys = list(user.webauthn_security_keys.all())
+
+    assert models._match_credential(keys, key.credential_id) == key
+    assert models._match_credential(keys, key.credential_id[:-1]) is None
+    assert models._match_credential([], key.credential_id) is None
+
+
+@pytest.mark.django_db
+def test_security_key_verify_authentication_other_user(test_auth_credential):
+    from django.contrib.auth import get_user_model
+
+    user, session, cred = test_auth_credential
+
+    other = get_user_model().objects.create_user("alice", password="user")
+
+    with pytest.raises(ValueError):
+        SecurityKey.verify_authentication(other, session, cred)
+
+    with pytest.raises(ValueError):
+        SecurityKey.verify_authentication(other.username, session, cred)
+
+
+@pytest.mark.django_db
+def test_security_key_verify_authentication_parsed(test_auth_credential):
+    user, session, cred = test_auth_credential
+
+    credential = SecurityKey.parse_authentication_credential(cred)
+
+    assert SecurityKey.parse_authentication_credential(credential) is credential
+    assert SecurityKey.verify_authentication(user.username, session, credential)
+
+
+@pytest.mark.django_db
+def test_security_key_averify_authentication(test_auth_credential):
+    user, session, cred = test_auth_credential
+
+    key = async_to_sync(SecurityKey.averify_authentication)(
+        user.username, session, cred
+    )
+    assert key
+
+
+@pytest.mark.django_db
+def test_security_key_verify_authentication_sign_count_race(
+    test_auth_credential, monkeypatch
+):
+    user, session, cred = test_auth_credential
+
+    run_verification = models._run_verification
+
+    def verify_concurrent(fn, **kwargs):
+        # concurrent authentication stores a higher sign count while
+        # this one is being verified
+        result = run_verification(fn, **kwargs)
+        user.webauthn_security_keys.update(sign_count=10)
+        return result
+
+    monkeypatch.setattr(models, "_run_verification", verify_concurrent)
+
+    key = SecurityKey.verify_authentication(user.username, session, cred)
+    key.refresh_from_db()
+    assert key.sign_count == 10
+
+
+@pytest.mark.django_db
+def test_security_key_verify_authentication_without_raw_key(test_auth_credential):
+    user, session, cred = test_auth_credential
+
+    # keys registered before the raw public key was introduced
+
+    user.webauthn_security_keys.update(credential_public_key_raw=None)
+
+    key = user.webauthn_security_keys.first()
+
+    assert SecurityKey.credentials(user, session)[0].id == base64url_to_bytes(
+        key.credential_id
+    )
+    assert SecurityKey.verify_authentication(user.username, session, cred)
+
 
 @pytest.mark.django_db
 def test_security_key_verify_authentication_passwordless_fail(test_auth_credential):
@@ -108,3 +292,83 @@ def test_security_key_verify_authentication_passwordless_success(test_auth_crede
     assert SecurityKey.verify_authentication(
         user.username, session, cred, for_login=True
     )
+
+
+@pytest.mark.django_db
+def test_security_key_verify_authentication_batch(test_auth_credential):
+    user, session, cred = test_auth_credential
+
+    keys = SecurityKey.verify_authentication_batch(user, session, [cred])
+
+    assert [key.id for key in keys] == [user.webauthn_security_keys.first().id]
+    assert keys[0].sign_count == 1
+
+    keys[0].refresh_from_db()
+    assert keys[0].sign_count == 1
+
+    with pytest.raises(KeyError):
+        SecurityKey.get_challenge(session)
+
+
+@pytest.mark.django_db
+def test_security_key_verify_authentication_batch_fail(test_auth_credential):
+    user, session, cred = test_auth_credential
+
+    # duplicate credentials
+
+    with pytest.raises(ValueError):
+        SecurityKey.verify_authentication_batch(user, session, [cred, cred])
+
+    # credential does not belong to user
+
+    with pytest.raises(ValueError):
+        SecurityKey.verify_authentication_batch("other", session, [cred])
+
+    # no credentials, challenge is left untouched
+
+    with pytest.raises(ValueError):
+        SecurityKey.verify_authentication_batch(user, session, [])
+
+    assert SecurityKey.get_challenge(session)
+
+
+@pytest.mark.django_db
+def test_security_key_verify_authentication_batch_multiple_keys(
+    test_auth_credential, monkeypatch
+):
+    user, session, cred = test_auth_credential
+
+    key = user.webauthn_security_keys.get()
+
+    # second key for the same user with a stored sign count that is
+    # higher than the one its assertion reports
+
+    other_key = user.webauthn_security_keys.get()
+    other_key.pk = None
+    other_key.credential_id = "b3RoZXIta2V5"
+    other_key.sign_count = 5
+    other_key.save()
+
+    other_cred = json.loads(cred)
+    other_cred["id"] = other_cred["rawId"] = other_key.credential_id
+    other_cred = json.dumps(other_cred)
+
+    new_sign_counts = {key.credential_id: 3, other_key.credential_id: 2}
+
+    monkeypatch.setattr(
+        models.webauthn,
+        "verify_authentication_response",
+        lambda credential, **kwargs: SimpleNamespace(
+            new_sign_count=new_sign_counts[credential.id]
+        ),
+    )
+
+    keys = SecurityKey.verify_authentication_batch(user, session, [cred, other_cred])
+
+    assert [k.id for k in keys] == [key.id, other_key.id]
+
+    key.refresh_from_db()
+    other_key.refresh_from_db()
+
+    assert key.sign_count == 3
+    assert other_key.sign_count == 5
@@ -1,104 +1,170 @@
-import json
-
 import pytest
-from django.test import Client
-from django.urls import reverse
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse, set_script_prefix
 from webauthn.helpers.exceptions import InvalidAuthenticationResponse
 
+from django_security_keys import views
 from django_security_keys.models import SecurityKey
 
 
+def test_reverse():
+    url = reverse("security-keys:manage-keys")
+
+    assert views._reverse("security-keys:manage-keys") == url
+
+    set_script_prefix("/prefix/")
+    try:
+        assert views._reverse("security-keys:manage-keys") == "/prefix" + url
+    finally:
+        set_script_prefix("/")
+
+
 @pytest.mark.django_db
-def test_login(user):
-    c = Client()
-    response = c.get(reverse("login"))
+def test_login(user, client):
+    response = client.get(reverse("login"))
     assert response.status_code == 200
 
-    response = c.post(reverse("login"), {"username": user.username, "password": "user"})
+    response = client.post(
+        reverse("login"), {"username": user.username, "password": "user"}
+    )
     assert response.status_code == 302
 
-    response = c.get(reverse("security-keys:manage-keys"))
+    response = client.get(reverse("security-keys:manage-keys"))
     assert "Your keys" in response.content.decode("utf-8")
 
 
 @pytest.mark.django_db
-def test_passwordless_login(test_auth_credential):
+def test_passwordless_login(test_auth_credential, client):
     user, session, cred = test_auth_credential
 
     key = user.webauthn_security_keys.first()
     key.passwordless_login = True
     key.save()
 
-    c = Client()
-    response = c.get(reverse("login"))
+    response = client.get(reverse("login"))
     assert response.status_code == 200
 
-    client_session = c.session
+    client_session = client.session
     SecurityKey.set_challenge(client_session, SecurityKey.get_challenge(session))
     client_session.save()
 
-    response = c.post(reverse("login"), {"username": user.username, "credential": cred})
+    response = client.post(
+        reverse("login"), {"username": user.username, "credential": cred}
+    )
     assert response.status_code == 302
 
-    response = c.get(reverse("security-keys:manage-keys"))
+    response = client.get(reverse("security-keys:manage-keys"))
     assert "Your keys" in response.content.decode("utf-8")
 
 
 @pytest.mark.django_db
-def test_passwordless_login_failure_invalid_signature(invalid_auth_credential):
+def test_passwordless_login_failure_invalid_signature(invalid_auth_credential, client):
     user, session, cred = invalid_auth_credential
 
     key = user.webauthn_security_keys.first()
     key.passwordless_login = True
     key.save()
 
-    c = Client()
-    response = c.get(reverse("login"))
+    response = client.get(reverse("login"))
     assert response.status_code == 200
 
-    client_session = c.session
+    client_session = client.session
     SecurityKey.set_challenge(client_session, SecurityKey.get_challenge(session))
     client_session.save()
 
     with pytest.raises(InvalidAuthenticationResponse):
-        response = c.post(
+        response = client.post(
             reverse("login"), {"username": user.username, "credential": cred}
         )
 
-    response = c.get(reverse("security-keys:manage-keys"))
+    response = client.get(reverse("security-keys:manage-keys"))
     assert "Your keys" not in response.content.decode("utf-8")
 
 
 @pytest.mark.django_db
-def test_passwordless_login_failure_key_not_enabled(test_auth_credential):
+@pytest.mark.parametrize("known_user", [True, False])
+def test_passwordless_login_failure_runs_hasher(
+    test_auth_credential, monkeypatch, client, known_user
+):
+    user, session, cred = test_auth_credential
+
+    # the key of a known user does not allow password-less login, so
+    # both cases fail before any signature verification and should cost
+    # one password hash each
+
+    username = user.username if known_user else "unknown"
+
+    hashed = []
+    monkeypatch.setattr(
+        get_user_model(), "set_password", lambda self, raw: hashed.append(raw)
+    )
+
+    response = client.post(
+        reverse("login"),
+        {"username": username, "password": "secret", "credential": cred},
+    )
+
+    assert response.status_code == 200
+    assert "didn't match" in response.content.decode("utf-8")
+    assert len(hashed) == 1
+
+
+@pytest.mark.django_db
+def test_passwordless_login_failure_unknown_user_queries(test_auth_credential, client):
+    user, session, cred = test_auth_credential
+
+    with CaptureQueriesContext(connection) as ctx:
+        response = client.post(
+            reverse("login"), {"username": "nobody", "credential": cred}
+        )
+
+    assert response.status_code == 200
+
+    # the user looked up by the login view is reused by the backend
+
+    user_queries = [q for q in ctx.captured_queries if '"auth_user"' in q["sql"]]
+    assert len(user_queries) == 1
+
+
+@pytest.mark.django_db
+def test_passwordless_login_failure_malformed_credential(user, client):
+    response = client.post(
+        reverse("login"), {"username": user.username, "credential": "not json"}
+    )
+
+    assert response.status_code == 200
+    assert "didn't match" in response.content.decode("utf-8")
+
+
+@pytest.mark.django_db
+def test_passwordless_login_failure_key_not_enabled(test_auth_credential, client):
     user, session, cred = test_auth_credential
 
-    c = Client()
-    response = c.get(reverse("login"))
+    response = client.get(reverse("login"))
     assert response.status_code == 200
 
-    client_session = c.session
+    client_session = client.session
     SecurityKey.set_challenge(client_session, SecurityKey.get_challenge(session))
     client_session.save()
 
-    response = c.post(reverse("login"), {"username": user.username, "credential": cred})
+    response = client.post(
+        reverse("login"), {"username": user.username, "credential": cred}
+    )
 
-    response = c.get(reverse("security-keys:manage-keys"))
+    response = client.get(reverse("security-keys:manage-keys"))
     assert "Your keys" not in response.content.decode("utf-8")
 
 
 @pytest.mark.django_db
-def test_django_two_factor_auth(test_auth_credential):
-    c = Client()
-
-    response = c.get(reverse("two-factor-auth:login"))
+def test_django_two_factor_auth(test_auth_credential, client):
+    response = client.get(reverse("two-factor-auth:login"))
     assert response.status_code == 200
 
-    c = Client()
-
     user, session, cred = test_auth_credential
 
-    response = c.post(
+    response = client.post(
         reverse("two-factor-auth:login"),
         {
             "auth-username": user.username,
@@ -110,20 +176,46 @@ def test_django_two_factor_auth(test_auth_credential):
 
 
 @pytest.mark.django_db
-def test_django_two_factor_auth_passwordless_login(test_auth_credential):
+def test_django_two_factor_auth_security_key_queries(test_auth_credential, client):
+    user, session, cred = test_auth_credential
+
+    with CaptureQueriesContext(connection) as ctx:
+        response = client.post(
+            reverse("two-factor-auth:login"),
+            {
+                "auth-username": user.username,
+                "auth-password": "user",
+                "login_view-current_step": "auth",
+            },
+        )
+
+    assert 'data-2fa-method="security-key"' in response.content.decode("utf-8")
+
+    # security key step condition and device lookup share the same
+    # request scoped credential lookup
+
+    key_queries = [
+        query
+        for query in ctx.captured_queries
+        if '"security_keys_security_key"' in query["sql"]
+    ]
+
+    assert len(key_queries) == 1
+
+
+@pytest.mark.django_db
+def test_django_two_factor_auth_passwordless_login(test_auth_credential, client):
     user, session, cred = test_auth_credential
 
     key = user.webauthn_security_keys.first()
     key.passwordless_login = True
     key.save()
 
-    c = Client()
-
-    client_session = c.session
+    client_session = client.session
     SecurityKey.set_challenge(client_session, SecurityKey.get_challenge(session))
     client_session.save()
 
-    response = c.post(
+    response = client.post(
         reverse("two-factor-auth:login"),
         {"auth-username": user.username, "credential": cred},
     )
@@ -131,13 +223,12 @@ def test_django_two_factor_auth_passwordless_login(test_auth_credential):
 
 
 @pytest.mark.django_db
-def test_manage_keys(security_key):
+def test_manage_keys(security_key, client):
     user, session, key = security_key
 
-    c = Client()
-    c.force_login(user)
+    client.force_login(user)
 
-    response = c.get(reverse("security-keys:manage-keys"))
+    response = client.get(reverse("security-keys:manage-keys"))
 
     content = response.content.decode("utf-8")
 
@@ -147,45 +238,67 @@ def test_manage_keys(security_key):
 
 
 @pytest.mark.django_db
-def test_request_registration(user):
-    c = Client()
-    c.force_login(user)
-
-    response = c.get(reverse("security-keys:request-registration"))
+def test_request_registration(auth_client):
+    response = auth_client.get(reverse("security-keys:request-registration"))
 
-    content = json.loads(response.content.decode("utf-8"))
+    content = response.json()
 
     assert content
     assert content["rp"]["name"] == "dsk sandbox"
 
 
 @pytest.mark.django_db
-def test_request_authentication(user):
-    c = Client()
-    c.force_login(user)
-
-    response = c.post(
+def test_request_authentication(user, auth_client):
+    response = auth_client.post(
         reverse("security-keys:request-authentication"), {"username": user.username}
     )
 
-    content = json.loads(response.content.decode("utf-8"))
+    content = response.json()
 
     assert content
     assert content["challenge"]
 
 
 @pytest.mark.django_db
-def test_register_security_key(test_credential):
+@pytest.mark.parametrize(
+    "url_name",
+    [
+        "security-keys:request-authentication",
+        "security-keys:register",
+        "security-keys:authenticate",
+        "security-keys:decommission",
+    ],
+)
+def test_post_required(url_name, auth_client):
+    response = auth_client.get(reverse(url_name))
+
+    assert response.status_code == 405
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_request_authentication_no_username(use_orjson, monkeypatch, client):
+    if not use_orjson:
+        monkeypatch.setattr(views, "orjson", None)
+
+    response = client.post(reverse("security-keys:request-authentication"), {})
+
+    assert response.status_code == 403
+    assert response["Content-Type"] == "application/json"
+    assert response.json() == {"non_field_errors": "No username supplied"}
+
+
+@pytest.mark.django_db
+def test_register_security_key(test_credential, client):
     user, session, cred = test_credential
 
-    c = Client()
-    c.force_login(user)
+    client.force_login(user)
 
-    client_session = c.session
+    client_session = client.session
     SecurityKey.set_challenge(client_session, SecurityKey.get_challenge(session))
     client_session.save()
 
-    response = c.post(
+    response = client.post(
         reverse("security-keys:register"),
         {
             "name": "test-key",
@@ -193,7 +306,7 @@ def test_register_security_key(test_credential):
         },
     )
 
-    content = json.loads(response.content.decode("utf-8"))
+    content = response.json()
 
     assert content
     assert content["status"] == "ok"
@@ -203,17 +316,54 @@ def test_register_security_key(test_credential):
 
 
 @pytest.mark.django_db
-def test_register_security_key_form(test_credential):
+@pytest.mark.parametrize(
+    "value,expected",
+    [
+        ("true", True),
+        ("True", True),
+        ("on", True),
+        ("1", True),
+        ("false", False),
+        ("", False),
+    ],
+)
+def test_register_security_key_passwordless(test_credential, value, expected, client):
+    user, session, cred = test_credential
+
+    client.force_login(user)
+
+    client_session = client.session
+    SecurityKey.set_challenge(client_session, SecurityKey.get_challenge(session))
+    client_session.save()
+
+    response = client.post(
+        reverse("security-keys:register"),
+        {
+            "name": "test-key",
+            "credential": cred,
+            "passwordless_login": value,
+        },
+    )
+
+    content = response.json()
+
+    assert content
+    assert content["status"] == "ok"
+
+    assert user.webauthn_security_keys.get().passwordless_login is expected
+
+
+@pytest.mark.django_db
+def test_register_security_key_form(test_credential, client):
     user, session, cred = test_credential
 
-    c = Client()
-    c.force_login(user)
+    client.force_login(user)
 
-    client_session = c.session
+    client_session = client.session
     SecurityKey.set_challenge(client_session, SecurityKey.get_challenge(session))
     client_session.save()
 
-    response = c.post(
+    response = client.post(
         reverse("security-keys:register-form"),
         {
             "name": "test-key",
@@ -228,16 +378,14 @@ def test_register_security_key_form(test_credential):
 
 
 @pytest.mark.django_db
-def test_verify_authentication(test_auth_credential):
+def test_verify_authentication(test_auth_credential, client):
     user, session, cred = test_auth_credential
 
-    c = Client()
-
-    client_session = c.session
+    client_session = client.session
     SecurityKey.set_challenge(client_session, SecurityKey.get_challenge(session))
     client_session.save()
 
-    response = c.post(
+    response = client.post(
         reverse("security-keys:authenticate"),
         {
             "username": user.username,
@@ -248,39 +396,53 @@ def test_verify_authentication(test_auth_credential):
 
     print(response.content)
 
-    content = json.loads(response.content.decode("utf-8"))
+    content = response.json()
 
     assert content
     assert content["status"] == "ok"
 
 
 @pytest.mark.django_db
-def test_remove_security_key(security_key):
+def test_remove_security_key(security_key, client):
     user, session, key = security_key
 
-    c = Client()
-    c.force_login(user)
+    client.force_login(user)
 
-    response = c.post(reverse("security-keys:decommission"), {"id": key.id})
+    response = client.post(reverse("security-keys:decommission"), {"id": key.id})
 
     assert response.status_code == 200
 
     assert user.webauthn_security_keys.count() == 0
 
-    content = json.loads(response.content.decode("utf-8"))
+    content = response.json()
 
     assert content
     assert content["status"] == "ok"
 
 
 @pytest.mark.django_db
-def test_remove_security_key_form(security_key):
+def test_remove_security_key_not_found(security_key, client):
+    from django.contrib.auth import get_user_model
+
+    user, session, key = security_key
+
+    other = get_user_model().objects.create_user("alice", password="user")
+
+    client.force_login(other)
+
+    response = client.post(reverse("security-keys:decommission"), {"id": key.id})
+
+    assert response.status_code == 404
+    assert user.webauthn_security_keys.count() == 1
+
+
+@pytest.mark.django_db
+def test_remove_security_key_form(security_key, client):
     user, session, key = security_key
 
-    c = Client()
-    c.force_login(user)
+    client.force_login(user)
 
-    response = c.post(reverse("security-keys:decommission-form"), {"id": key.id})
+    response = client.post(reverse("security-keys:decommission-form"), {"id": key.id})
 
     assert response.status_code == 302
     assert user.webauthn_security_keys.count() == 0